@@ -0,0 +1,15 @@
+import multiprocessing
+import os
+
+# Gevent workers let each process serve many requests concurrently while they wait on the database.
+bind = "0.0.0.0:" + os.environ.get("PORT", "5000")
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_connections = 1000
+
+
+# The gevent worker monkey-patches the stdlib, but psycopg2 talks to Postgres from C, so it has to be
+# told to yield to the event loop explicitly or every query would block the whole worker.
+def post_fork(server, worker):
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -4,22 +4,63 @@ from flask_ckeditor import CKEditor
 from datetime import date
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, joinedload, selectinload, defer
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
-from flask_gravatar import Gravatar
-from functools import wraps
+from flask_caching import Cache
+from jinja2 import FileSystemBytecodeCache
+from functools import wraps, lru_cache
+from cachetools import TTLCache
+import threading
+import hashlib
 import os
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY")
+# Let browsers and any CDN in front of the app keep static files for a year instead of revalidating them.
+# Static URLs carry the file's modification time (see static_url_version), so a changed file gets a new URL.
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000
+# Explicit pbkdf2 iteration count; hashes store their own method, so older ones still verify.
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256:60000")
 ckeditor = CKEditor(app)
 Bootstrap(app)
 
+# Persist compiled templates in the temp dir so restarted workers don't re-parse them. Template auto-reload
+# follows debug mode, so it is off when served by gunicorn.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+# Rendered pages cache. With REDIS_URL set it is shared by all workers, so clearing it after a change takes
+# effect everywhere. Without it each gunicorn worker keeps its own SimpleCache and a clear only reaches the
+# worker that handled the change, so the other workers can serve a stale page until it expires; the timeout
+# is kept short in that case to bound the staleness.
+if os.environ.get("REDIS_URL"):
+    app.config['CACHE_TYPE'] = "RedisCache"
+    app.config['CACHE_REDIS_URL'] = os.environ.get("REDIS_URL")
+    app.config['CACHE_DEFAULT_TIMEOUT'] = 300
+else:
+    app.config['CACHE_TYPE'] = "SimpleCache"
+    app.config['CACHE_DEFAULT_TIMEOUT'] = 30
+cache = Cache(app)
+
 # CONNECT TO DB
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL")  # 'sqlite:///blog.db'
+# SQLAlchemy 1.4 only accepts the "postgresql://" scheme, while Heroku still hands out "postgres://" URLs.
+app.config['SQLALCHEMY_DATABASE_URI'] = (os.environ.get("DATABASE_URL") or "").replace(
+    "postgres://", "postgresql://", 1) or None  # 'sqlite:///blog.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+# Keep a warm pool of connections per worker and drop stale ones before use. The sizes are per gunicorn
+# worker, so the server can open up to WEB_CONCURRENCY * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections in total.
+# SQLite (local dev) uses its own pool class, which doesn't accept these sizing options.
+if not (app.config['SQLALCHEMY_DATABASE_URI'] or "").startswith("sqlite"):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get("DB_POOL_SIZE", 5)),
+        'max_overflow': int(os.environ.get("DB_MAX_OVERFLOW", 5)),
+        'pool_timeout': 30,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    }
+# Don't expire loaded objects on commit, so reading current_user or a just-saved post afterwards doesn't
+# trigger a reload; this also keeps users held in the load_user cache usable after the request that loaded them.
+db = SQLAlchemy(app, session_options={'expire_on_commit': False})
 
 
 # CONFIGURE TABLES
@@ -29,13 +70,13 @@ class BlogPost(db.Model):
     id = db.Column(db.Integer, primary_key=True)
 
     # Create Foreign Key, "users.id" the users refers to the table name of User.
-    author_id = db.Column(db.Integer, db.ForeignKey("Users.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("Users.id"), index=True)
     # Create reference to the User object, the "posts" refers to the posts property in the User class.
     author = relationship("User", back_populates="posts")
 
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    date = db.Column(db.Date, nullable=False, default=date.today)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
     comments = relationship("Comment", back_populates="parent_post")
@@ -44,9 +85,10 @@ class BlogPost(db.Model):
 class User(UserMixin, db.Model):
     __tablename__ = "Users"
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(250), unique=True, nullable=False)
+    email = db.Column(db.String(250), unique=True, index=True, nullable=False)
     password = db.Column(db.String(250), nullable=False)
     name = db.Column(db.String(250), nullable=False)
+    is_admin = db.Column(db.Boolean, default=False, nullable=False)
 
     # This will act like a List of BlogPost objects attached to each User.
     # The "author" refers to the author property in the BlogPost class.
@@ -58,11 +100,11 @@ class User(UserMixin, db.Model):
 class Comment(UserMixin, db.Model):
     __tablename__ = "comments"
     id = db.Column(db.Integer, primary_key=True)
-    author_id = db.Column(db.Integer, db.ForeignKey("Users.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("Users.id"), index=True)
     comment_author = relationship("User", back_populates="comments")
     text = db.Column(db.Text, nullable=False)
     parent_post = relationship("BlogPost", back_populates="comments")
-    post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"))
+    post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"), index=True)
 
 
 db.create_all()
@@ -71,19 +113,48 @@ db.create_all()
 login_manager = LoginManager()
 login_manager.init_app(app)
 
-# Initialize with flask to auto generate users photos
+# Gravatar to auto generate users photos, the email hash is memoized so it isn't recomputed per comment per render
 # Angela original photo url = "https://pbs.twimg.com/profile_images/744849215675838464/IH0FNIXk.jpg"
-gravatar = Gravatar(app, size=100, rating='g', default='retro', force_default=False, force_lower=False, use_ssl=False,
-                    base_url=None)
+@lru_cache(maxsize=1024)
+def gravatar_hash(email):
+    return hashlib.md5(email.strip().lower().encode("utf-8")).hexdigest()
+
+
+@app.template_global()
+def gravatar_url(user):
+    return f"https://www.gravatar.com/avatar/{gravatar_hash(user.email)}?s=100&d=retro&r=g"
+
+
+# Posts store a real date and are formatted for display only when rendered
+@app.template_filter("post_date")
+def format_post_date(value):
+    return value.strftime("%B %d, %Y")
+
 
+# Static files only change on deploy, which restarts the workers, so each file's mtime is looked up once
+@lru_cache(maxsize=None)
+def static_file_mtime(filename):
+    try:
+        return int(os.path.getmtime(os.path.join(app.static_folder, filename)))
+    except OSError:
+        return None
 
-# Checking if the logged in user has the id = 1, which means he is the admin and will be granted access to
+
+@app.url_defaults
+def static_url_version(endpoint, values):
+    if endpoint == "static" and "filename" in values:
+        mtime = static_file_mtime(values["filename"])
+        if mtime is not None:
+            values.setdefault("v", mtime)
+
+
+# Checking if the logged in user is an admin, only admins are granted access to
 # edit post, create new post or delete a certain post
 def admin_only(function):
     @wraps(function)
-    def wrapper():
-        if current_user.id == 1:
-            return function()
+    def wrapper(*args, **kwargs):
+        if current_user.is_authenticated and current_user.is_admin:
+            return function(*args, **kwargs)
         else:
             return abort(403)
             # return "<h1>Forbidden</h1>" \
@@ -92,30 +163,79 @@ def admin_only(function):
     return wrapper
 
 
+# Short-lived per-process cache of logged in users, so current_user doesn't cost a SELECT on every request.
+# Kept short since other workers can't invalidate it.
+user_cache = TTLCache(maxsize=1024, ttl=60)
+user_cache_lock = threading.Lock()
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    with user_cache_lock:
+        user = user_cache.get(user_id)
+    if user is not None:
+        # Attach the cached instance to this request's session without reloading it.
+        return db.session.merge(user, load=False)
+    user = db.session.get(User, user_id)
+    if user is not None:
+        with user_cache_lock:
+            user_cache[user_id] = user
+    return user
+
+
+def forget_user(user_id):
+    with user_cache_lock:
+        user_cache.pop(user_id, None)
+
+
+# The index page differs only by whether the visitor is anonymous, a regular user or the admin,
+# so it is cached once per role and dropped whenever a post is added, edited or deleted.
+INDEX_CACHE_KEYS = ("index:anonymous", "index:user", "index:admin")
+
+
+def index_cache_key():
+    if not current_user.is_authenticated:
+        return "index:anonymous"
+    elif current_user.is_admin:
+        return "index:admin"
+    return "index:user"
+
+
+def clear_index_cache():
+    # delete_many() stops at the first key that isn't cached, so each key is deleted on its own
+    for key in INDEX_CACHE_KEYS:
+        cache.delete(key)
+
+
+# Insert many posts in one batch and a single commit, e.g. when importing posts. Relationships aren't
+# followed by bulk saves, so each post must carry its author_id rather than an author object.
+def bulk_create_posts(posts):
+    db.session.bulk_save_objects(list(posts))
+    db.session.commit()
+    clear_index_cache()
 
 
 @app.route('/')
+@cache.cached(key_prefix=index_cache_key)
 def get_all_posts():
-    posts = BlogPost.query.all()
-    users = User.query.all()
-    return render_template("index.html", all_posts=posts, logged_in=current_user.is_active, all_users=users)
+    # Load each post's author in the same query so the template doesn't issue a SELECT per post,
+    # and leave out the post bodies, which the listing never shows.
+    posts = BlogPost.query.options(joinedload(BlogPost.author), defer(BlogPost.body)).all()
+    return render_template("index.html", all_posts=posts, logged_in=current_user.is_active)
 
 
 @app.route('/register', methods=["POST", "GET"])
 def register():
     error = None
-    login_form = LoginForm()
-    register_form = RegisterForm()
     if request.method == "POST":
         name = request.form["name"]
         password = request.form["password"]
         email = request.form["email"]
-        user = User.query.filter_by(email=email).first()
-        if user is None:
-            encrypt_password = generate_password_hash(password, method='pbkdf2:sha256', salt_length=8)
+        # Only check whether the email is taken, without loading the user row and its password hash
+        email_taken = db.session.execute(db.select(db.exists().where(User.email == email))).scalar()
+        if not email_taken:
+            encrypt_password = generate_password_hash(password, method=PASSWORD_HASH_METHOD, salt_length=8)
             new_user = User(name=name, password=encrypt_password, email=email)
             db.session.add(new_user)
             db.session.commit()
@@ -123,58 +243,63 @@ def register():
             return redirect(url_for("get_all_posts", logged_in=current_user.is_active))
         else:
             error = "You have already signed up with that email, log in instead!"
-            return render_template("login.html", error=error, form=login_form, logged_in=current_user.is_active)
+            return render_template("login.html", error=error, form=LoginForm(), logged_in=current_user.is_active)
     elif request.method == "GET":
-        return render_template("register.html", form=register_form, logged_in=current_user.is_active)
+        return render_template("register.html", form=RegisterForm(), logged_in=current_user.is_active)
 
 
 @app.route('/login', methods=["POST", "GET"])
 def login():
-    login_form = LoginForm()
     if request.method == "POST":
         email = request.form["email"]
         password = request.form["password"]
-        user = User.query.filter_by(email=email).first()
+        user = db.session.execute(db.select(User).filter_by(email=email)).scalar_one_or_none()
         if user is None:
             error = "the Email you entered doesn't exist, please try again!"
-            return render_template("login.html", error=error, form=login_form, logged_in=current_user.is_active)
+            return render_template("login.html", error=error, form=LoginForm(), logged_in=current_user.is_active)
         else:
             if check_password_hash(user.password, password):
                 login_user(user)
                 return redirect(url_for("get_all_posts"))
             else:
                 error = "Password Incorrect, Please try again!"
-                return render_template("login.html", error=error, form=login_form, logged_in=current_user.is_active)
+                return render_template("login.html", error=error, form=LoginForm(), logged_in=current_user.is_active)
     elif request.method == "GET":
-        error = request.args["error"]
-        return render_template("login.html", form=login_form, error=error, logged_in=current_user.is_active)
+        return render_template("login.html", form=LoginForm(), logged_in=current_user.is_active)
 
 
 @app.route('/logout')
 def logout():
+    if current_user.is_authenticated:
+        forget_user(current_user.id)
     logout_user()
     return redirect(url_for('get_all_posts', logged_in=current_user.is_active))
 
 
 @app.route("/post/<int:post_id>", methods=["POST", "GET"])
 def show_post(post_id):
-    comment_form = CommentForm()
     if request.method == "GET":
-        all_comments = Comment.query.all()
-        requested_post = BlogPost.query.get(post_id)
-        author_name = User.query.filter_by(id=requested_post.author_id).first().name
+        # Fetch the post with its author, then this post's comments and their authors in one extra query.
+        requested_post = db.session.get(BlogPost, post_id, options=[
+            joinedload(BlogPost.author),
+            selectinload(BlogPost.comments).joinedload(Comment.comment_author)
+        ]) or abort(404)
         return render_template("post.html", post=requested_post, logged_in=current_user.is_active,
-                               author_name=author_name, form=comment_form, comments=all_comments)
+                               author_name=requested_post.author.name,
+                               form=CommentForm() if current_user.is_active else None,
+                               comments=requested_post.comments)
     elif request.method == "POST":
         if current_user.is_active:
+            comment_form = CommentForm()
             if comment_form.validate_on_submit():
+                db.session.get(BlogPost, post_id) or abort(404)
                 new_comment = Comment(author_id=current_user.id, text=comment_form.comment.data, post_id=post_id)
                 db.session.add(new_comment)
                 db.session.commit()
                 return redirect(url_for("get_all_posts"))
         else:
-            error = "You need to logged first in in order to be able to add comments!"
-            return redirect(url_for("login", error=error))
+            flash("You need to logged first in in order to be able to add comments!")
+            return redirect(url_for("login"))
 
 
 @app.route("/about")
@@ -198,11 +323,11 @@ def add_new_post():
             subtitle=form.subtitle.data,
             body=form.body.data,
             img_url=form.img_url.data,
-            author=current_user,
-            date=date.today().strftime("%B %d, %Y")
+            author=current_user
         )
         db.session.add(new_post)
         db.session.commit()
+        clear_index_cache()
         return redirect(url_for("get_all_posts"))
     return render_template("make-post.html", form=form, logged_in=current_user.is_active)
 
@@ -211,7 +336,7 @@ def add_new_post():
 @login_required
 @admin_only
 def edit_post(post_id):
-    post = BlogPost.query.get(post_id)
+    post = db.session.get(BlogPost, post_id) or abort(404)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -226,6 +351,7 @@ def edit_post(post_id):
         post.author = edit_form.author.data
         post.body = edit_form.body.data
         db.session.commit()
+        clear_index_cache()
         return redirect(url_for("show_post", post_id=post.id, logged_in=current_user.is_active))
 
     return render_template("make-post.html", form=edit_form, logged_in=current_user.is_active)
@@ -235,9 +361,10 @@ def edit_post(post_id):
 @login_required
 @admin_only
 def delete_post(post_id):
-    post_to_delete = BlogPost.query.get(post_id)
+    post_to_delete = db.session.get(BlogPost, post_id) or abort(404)
     db.session.delete(post_to_delete)
     db.session.commit()
+    clear_index_cache()
     return redirect(url_for('get_all_posts', logged_in=current_user.is_active))
 
 
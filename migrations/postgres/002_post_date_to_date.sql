@@ -0,0 +1,9 @@
+-- Convert blog_posts.date from "August 09, 2021" style strings to a real date column.
+-- Run with: psql "$DATABASE_URL" -f migrations/postgres/002_post_date_to_date.sql
+BEGIN;
+ALTER TABLE blog_posts ALTER COLUMN date TYPE date USING (
+    CASE WHEN date ~ '^\d{4}-\d{2}-\d{2}$' THEN date::date
+         ELSE to_date(date, 'FMMonth DD, YYYY')
+    END
+);
+COMMIT;
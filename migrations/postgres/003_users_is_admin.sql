@@ -0,0 +1,6 @@
+-- Add the Users.is_admin flag and keep the original admin (user 1) as admin.
+-- Run with: psql "$DATABASE_URL" -f migrations/postgres/003_users_is_admin.sql
+BEGIN;
+ALTER TABLE "Users" ADD COLUMN is_admin boolean NOT NULL DEFAULT false;
+UPDATE "Users" SET is_admin = true WHERE id = 1;
+COMMIT;
@@ -0,0 +1,6 @@
+-- Index the foreign key columns used to look up a post's comments and authors.
+-- "Users".email is already indexed by its unique constraint.
+-- Run with: sqlite3 blog.db < migrations/sqlite/001_add_indexes.sql
+CREATE INDEX IF NOT EXISTS ix_blog_posts_author_id ON blog_posts (author_id);
+CREATE INDEX IF NOT EXISTS ix_comments_post_id ON comments (post_id);
+CREATE INDEX IF NOT EXISTS ix_comments_author_id ON comments (author_id);
@@ -0,0 +1,15 @@
+-- Convert blog_posts.date from "August 09, 2021" style strings to ISO dates, which is what
+-- SQLAlchemy's Date type reads and writes on SQLite.
+-- Run with: sqlite3 blog.db < migrations/sqlite/002_post_date_to_date.sql
+BEGIN;
+UPDATE blog_posts SET date =
+    substr(date, -4) || '-' ||
+    CASE substr(date, 1, instr(date, ' ') - 1)
+        WHEN 'January' THEN '01' WHEN 'February' THEN '02' WHEN 'March' THEN '03'
+        WHEN 'April' THEN '04' WHEN 'May' THEN '05' WHEN 'June' THEN '06'
+        WHEN 'July' THEN '07' WHEN 'August' THEN '08' WHEN 'September' THEN '09'
+        WHEN 'October' THEN '10' WHEN 'November' THEN '11' WHEN 'December' THEN '12'
+    END || '-' ||
+    substr(date, instr(date, ' ') + 1, 2)
+WHERE date LIKE '% __, ____';
+COMMIT;
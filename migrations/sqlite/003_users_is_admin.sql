@@ -0,0 +1,6 @@
+-- Add the Users.is_admin flag and keep the original admin (user 1) as admin.
+-- Run with: sqlite3 blog.db < migrations/sqlite/003_users_is_admin.sql
+BEGIN;
+ALTER TABLE "Users" ADD COLUMN is_admin BOOLEAN NOT NULL DEFAULT 0;
+UPDATE "Users" SET is_admin = 1 WHERE id = 1;
+COMMIT;